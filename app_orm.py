@@ -1,5 +1,6 @@
 # app_orm.py
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, g
+from jinja2 import FileSystemBytecodeCache
 from expense_tracker_sqlalchemy import ExpenseTrackerORM
 from flask_login import (
     LoginManager, UserMixin, login_user, logout_user,
@@ -9,6 +10,8 @@ import os
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET", "CHANGE_ME_TO_A_RANDOM_SECRET")
+# 模板編譯結果存磁碟，worker 重啟後首個 request 不必重新 parse 模板
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 # === 初始化 ORM（依你的 MySQL 設定調整） ===
 DB_HOST = os.getenv('DB_HOST', 'localhost')
@@ -23,6 +26,11 @@ tracker = ExpenseTrackerORM(
     password=DB_PASS
 )
 
+@app.teardown_appcontext
+def remove_db_session(exc=None):
+    # scoped_session 的 request 結束清理，連線歸還 pool
+    tracker.Session.remove()
+
 # === Flask-Login 設定 ===
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
@@ -34,8 +42,13 @@ class AuthUser(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id: str):
+    # 同一個 request 內不重複查 DB
+    cached = getattr(g, '_auth_user', None)
+    if cached is not None and cached.id == user_id:
+        return cached
     u = tracker.get_user_by_id(int(user_id))
-    return AuthUser(u['id'], u['username']) if u else None
+    g._auth_user = AuthUser(u['id'], u['username']) if u else None
+    return g._auth_user
 
 # === Auth Routes ===
 @app.route('/register', methods=['GET', 'POST'])
@@ -82,16 +95,12 @@ def home():
     balance = tracker.get_balance(uid)
     transactions = tracker.get_transactions(uid, 10)
 
-    # 若你想直接用統計，亦可：income_total = balance['total_income'] ...
-    income_total = sum(t[1] for t in transactions if t[3] == 'income')
-    expense_total = sum(t[1] for t in transactions if t[3] == 'expense')
-
-    return render_template(
+    # 統計直接沿用 get_balance 的結果，不再於 Python 端重算；
+    # stream_template 讓回應邊算邊送，不等整頁 render 完
+    return stream_template(
         'index.html',
         balance=balance,
-        transactions=transactions,
-        income_total=income_total,
-        expense_total=expense_total
+        transactions=transactions
     )
 
 # === 分類管理 ===
@@ -1,13 +1,20 @@
 from sqlalchemy import (
     create_engine, Column, Integer, String, Float, Text, Date, DateTime,
-    Enum, ForeignKey, Index, UniqueConstraint, func
+    Enum, ForeignKey, Index, UniqueConstraint, func, select, text, bindparam, tuple_,
+    inspect
 )
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, joinedload
+from contextlib import contextmanager
+from datetime import datetime, date as date_cls
 from typing import List, Optional, Tuple, Dict
 from werkzeug.security import generate_password_hash, check_password_hash
 import enum
+import functools
+import threading
+import time
 
 # 建立基底類別
 Base = declarative_base()
@@ -62,74 +69,254 @@ class Transaction(Base):
     user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     amount = Column(Float, nullable=False)
     category_id = Column(Integer, ForeignKey('categories.id', ondelete='SET NULL'))
+    # 從 Category 複製過來的類型快照，彙總時免 JOIN categories
+    category_type = Column(Enum(CategoryType), nullable=True)
     description = Column(Text)
     date = Column(Date, nullable=False)
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
-    user = relationship("User", back_populates="transactions")
-    category = relationship("Category", back_populates="transactions")
+    # lazy="raise"：迴圈內若忘了 joinedload 會直接報錯，而不是默默 N+1
+    user = relationship("User", back_populates="transactions", lazy="raise")
+    category = relationship("Category", back_populates="transactions", lazy="raise")
 
     __table_args__ = (
-        Index('idx_trans_user', 'user_id'),
-        Index('idx_trans_date', 'date'),
-        Index('idx_trans_category', 'category_id'),
+        # 對齊 get_transactions 的 WHERE user_id + ORDER BY date/created_at DESC，
+        # 讓 LIMIT 10 變成索引範圍掃描（MySQL 8 降冪索引），免 filesort
+        Index('idx_trans_user_date_created', 'user_id', text('date DESC'), text('created_at DESC')),
+        # (category_id, date)：FK JOIN 與未來 per-category 期間查詢共用；
+        # 單欄 idx_trans_date 已無對應查詢（日期條件都帶 user_id 走上面的複合索引）
+        Index('idx_trans_cat_date', 'category_id', 'date'),
+        # 覆蓋 (user_id, category_type, amount)：type 彙總可走 index-only scan
+        Index('idx_trans_user_type_amount', 'user_id', 'category_type', 'amount'),
     )
 
     def __repr__(self):
         return f"<Transaction(id={self.id}, user_id={self.user_id}, amount={self.amount}, date='{self.date}')>"
 
+# 每人每月收支彙總（denormalized），讓 get_balance 不必掃整張 transactions
+class BalanceAggregate(Base):
+    __tablename__ = 'balance_aggregates'
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    month = Column(String(7), primary_key=True)  # 'YYYY-MM'
+    type = Column(Enum(CategoryType), primary_key=True)
+    total = Column(Float, nullable=False, default=0.0)
+
+    def __repr__(self):
+        return f"<BalanceAggregate(user_id={self.user_id}, month='{self.month}', type='{self.type.value}', total={self.total})>"
+
+# 熱路徑的 SELECT 建成模組層常數：同一個 statement 物件重複執行，
+# SQLAlchemy 的編譯快取直接命中，不必每次重走 query builder
+_BALANCE_STMT = (
+    select(BalanceAggregate.type, func.sum(BalanceAggregate.total))
+    .where(BalanceAggregate.user_id == bindparam("user_id"))
+    .group_by(BalanceAggregate.type)
+)
+
+_TRANSACTIONS_BASE_STMT = (
+    select(
+        Transaction.id,
+        Transaction.amount,
+        func.coalesce(Category.name, "未分類").label("category_name"),
+        Category.type.label("category_type"),
+        func.coalesce(Transaction.description, "").label("description"),
+        Transaction.date,
+    )
+    .outerjoin(Category, Transaction.category_id == Category.id)
+    .where(Transaction.user_id == bindparam("user_id"))
+    # id 當 tiebreaker：created_at 只有秒級精度（批次匯入整批同秒），
+    # 沒有它排序不穩定、分頁會漏掉同游標值的列
+    .order_by(Transaction.date.desc(), Transaction.created_at.desc(), Transaction.id.desc())
+    .limit(bindparam("limit"))
+)
+
+_TRANSACTIONS_STMT = _TRANSACTIONS_BASE_STMT
+
+# keyset 分頁版：用 (date, created_at, id) 當游標，翻到深頁也只要一次索引 seek
+# （bindparam 要標型別，游標值才會用欄位的格式綁定，而不是 NullType 原樣送出）
+_TRANSACTIONS_AFTER_STMT = _TRANSACTIONS_BASE_STMT.where(
+    tuple_(Transaction.date, Transaction.created_at, Transaction.id)
+    < tuple_(
+        bindparam("last_date", type_=Date),
+        bindparam("last_created", type_=DateTime),
+        bindparam("last_id", type_=Integer),
+    )
+)
+
+_CATEGORIES_STMT = (
+    select(Category.id, Category.name, Category.type)
+    .where(Category.user_id == bindparam("user_id"))
+    .order_by(Category.type, Category.name)
+)
+
+def _transaction_row_to_tuple(row):
+    return (
+        row.id,
+        row.amount,
+        row.category_name,
+        row.category_type.value if row.category_type is not None else "unknown",
+        row.description,
+        row.date,
+    )
+
+def _retry_on_disconnect(method):
+    """關掉 pool_pre_ping 後，連線可能已被 MySQL 收走；碰到斷線錯誤換新連線重試一次。
+
+    只能掛在「唯讀」方法上：寫入方法的 commit 可能在伺服器端已成功、
+    回應途中才斷線，盲目重跑整個方法會重複寫入（例如彙總表加兩次）。
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except OperationalError as e:
+            print(f"⚠️ 資料庫連線失效，重試一次: {e}")
+            self.Session.remove()
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class ExpenseTrackerORM:
-    def __init__(self, host='localhost', database='expense_tracker', user='root', password=''):
-        """初始化記帳系統 - SQLAlchemy ORM 版本（含使用者與資料隔離）"""
+    def __init__(self, host='localhost', database='expense_tracker', user='root', password='',
+                 pool_size=20, max_overflow=10, pool_timeout=30, poolclass=None):
+        """初始化記帳系統 - SQLAlchemy ORM 版本（含使用者與資料隔離）
+
+        pool_size/max_overflow/pool_timeout 依部署的 worker 數調整；
+        單連線情境（如 CLI 腳本）可傳 poolclass=SingletonThreadPool
+        跳過 QueuePool 的鎖與額度管理。
+        """
         self.database_url = f"mysql+pymysql://{user}:{password}@{host}/{database}?charset=utf8mb4"
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.poolclass = poolclass
         self.engine = None
         self.Session = None
+        # 分類異動少但每頁都會查，做 per-user 的短 TTL 快取
+        self._cat_cache: Dict[int, Tuple[List[tuple], float]] = {}
+        self._cat_cache_lock = threading.Lock()
+        self._cat_cache_ttl = 60.0
         self.init_database()
 
     # === 初始化 ===
     def init_database(self):
+        """建立 engine 與資料表。
+
+        query_cache_size=1200：SQL 編譯結果的 LRU 快取；熱路徑查詢都是
+        模組層 select() 常數（無 lambda、無 literal），皆可被快取。
+        驗證方式：以 echo="debug" 跑一輪，log 不應出現 [no key]。
+        """
         try:
-            self.engine = create_engine(
-                self.database_url,
-                echo=False,
-                pool_recycle=3600,
-                pool_pre_ping=True
-            )
-            self.Session = sessionmaker(bind=self.engine)
+            engine_kwargs = {
+                "echo": False,
+                # 不開 pre_ping（每次 checkout 省一趟 SELECT 1）；
+                # 改用較短的 recycle，殘存的失效連線由 _retry_on_disconnect 兜底
+                "pool_recycle": 1800,
+                "pool_pre_ping": False,
+                "query_cache_size": 1200,
+                # 批次寫入走單一多列 INSERT ... VALUES (...),(...)，
+                # 一次最多 1000 列；超大匯入可在 database_url 加 ?local_infile=1
+                # 改用 LOAD DATA LOCAL INFILE
+                "insertmanyvalues_page_size": 1000,
+            }
+            if self.poolclass is not None:
+                engine_kwargs["poolclass"] = self.poolclass
+            else:
+                # QueuePool：容量依 worker 數調整，LIFO 讓熱連線留在 pool 頂端
+                engine_kwargs.update(
+                    pool_size=self.pool_size,
+                    max_overflow=self.max_overflow,
+                    pool_timeout=self.pool_timeout,
+                    pool_use_lifo=True,
+                )
+            self.engine = create_engine(self.database_url, **engine_kwargs)
+            # scoped_session：同一執行緒（= 同一個 request）重用同一個 session，
+            # 用完由 app 端 teardown 呼叫 Session.remove()
+            # expire_on_commit=False：commit 後讀屬性不再觸發 refresh SELECT
+            self.Session = scoped_session(sessionmaker(bind=self.engine, expire_on_commit=False))
 
             # 只建立不存在的資料表，**不要** drop_all()
             Base.metadata.create_all(self.engine)
+            self._migrate_schema()
             print("✅ SQLAlchemy ORM 資料庫初始化完成！")
         except Exception as e:
             print(f"❌ 資料庫初始化失敗: {e}")
 
-    # === 使用者 ===
-    def create_user(self, username: str, password: str) -> Tuple[bool, str, Optional[Dict]]:
-        """用 username 建立帳號；回傳 (ok, msg, user_dict)"""
-        session = self.Session()
-        try:
-            username = (username or "").strip()
-            if not username:
-                return False, "帳號 ID 不可為空", None
-
-            # 檢查帳號是否重複
-            if session.query(User).filter(User.username == username).first():
-                return False, "帳號 ID 已被使用", None
+    def _migrate_schema(self):
+        """升級既有資料庫：create_all 只建「新表」，後來加到舊表的欄位與索引在這裡補。
+
+        目前涵蓋 transactions.category_type（加完後請跑一次
+        rebuild_balance_aggregates() 回填快照與彙總表）以及改版後的複合索引；
+        被取代的舊單欄索引不主動 DROP，留給 DBA 手動清。
+        """
+        inspector = inspect(self.engine)
+        if "transactions" not in inspector.get_table_names():
+            return
+
+        columns = {col["name"] for col in inspector.get_columns("transactions")}
+        if "category_type" not in columns:
+            with self.engine.begin() as conn:
+                conn.execute(text(
+                    "ALTER TABLE transactions "
+                    "ADD COLUMN category_type ENUM('income','expense') NULL AFTER category_id"
+                ))
+            print("✅ 已補上 transactions.category_type，請跑 rebuild_balance_aggregates() 回填")
 
-            user = User(username=username, password_hash=generate_password_hash(password))
-            session.add(user)
-            session.commit()  # 取得 user.id
+        existing_indexes = {ix["name"] for ix in inspector.get_indexes("transactions")}
+        for index in Transaction.__table__.indexes:
+            if index.name not in existing_indexes:
+                index.create(self.engine)
 
-            self._add_default_categories_for_user(session, user.id)
-            session.commit()
-            return True, "註冊成功", {"id": user.id, "username": user.username}
+    def reset_database(self) -> bool:
+        """**銷毀性** 重置：drop 後重建所有資料表。啟動流程絕不呼叫，只供手動使用。"""
+        try:
+            Base.metadata.drop_all(self.engine)
+            Base.metadata.create_all(self.engine)
+            with self._cat_cache_lock:
+                self._cat_cache.clear()
+            print("✅ 資料庫已重置")
+            return True
         except Exception as e:
+            print(f"❌ 資料庫重置失敗: {e}")
+            return False
+
+    @contextmanager
+    def _session(self):
+        """取用 scoped session：真的出例外才 rollback，結束一律 close 歸還連線"""
+        session = self.Session()
+        try:
+            yield session
+        except Exception:
             session.rollback()
-            return False, f"建立用戶失敗: {e}", None
+            raise
         finally:
             session.close()
 
+    # === 使用者 ===
+    def create_user(self, username: str, password: str) -> Tuple[bool, str, Optional[Dict]]:
+        """用 username 建立帳號；回傳 (ok, msg, user_dict)"""
+        try:
+            with self._session() as session:
+                username = (username or "").strip()
+                if not username:
+                    return False, "帳號 ID 不可為空", None
+
+                # 檢查帳號是否重複（只撈 id，不整列 SELECT）
+                if session.query(User.id).filter(User.username == username).limit(1).scalar() is not None:
+                    return False, "帳號 ID 已被使用", None
+
+                # scrypt：安全強度同級但驗證成本比預設 pbkdf2(60萬次迭代)低
+                user = User(username=username,
+                            password_hash=generate_password_hash(password, method="scrypt:32768:8:1"))
+                session.add(user)
+                session.commit()  # 取得 user.id
+
+                self._add_default_categories_for_user(session, user.id)
+                session.commit()
+                return True, "註冊成功", {"id": user.id, "username": user.username}
+        except Exception as e:
+            return False, f"建立用戶失敗: {e}", None
+
     def _add_default_categories_for_user(self, session, user_id: int):
         default_categories = [
             ('薪水', CategoryType.income),
@@ -143,197 +330,353 @@ class ExpenseTrackerORM:
             ('醫療', CategoryType.expense),
             ('其他支出', CategoryType.expense)
         ]
-        for name, cat_type in default_categories:
-            session.add(Category(user_id=user_id, name=name, type=cat_type))
+        # .values([...])：編譯成單一條 INSERT ... VALUES (...),(...)，
+        # 不依賴 driver 的 executemany 改寫，保證一趟往返
+        session.execute(
+            Category.__table__.insert().values(
+                [{"user_id": user_id, "name": name, "type": cat_type}
+                 for name, cat_type in default_categories]
+            )
+        )
 
+    @_retry_on_disconnect
     def verify_user(self, username: str, password: str) -> Optional[Dict]:
         """用 username + 密碼登入"""
-        session = self.Session()
-        try:
+        with self._session() as session:
             u = session.query(User).filter(User.username == (username or "").strip()).first()
             if u and check_password_hash(u.password_hash, password):
                 return {"id": u.id, "username": u.username}
             return None
-        finally:
-            session.close()
 
+    @_retry_on_disconnect
     def get_user_by_id(self, user_id: int) -> Optional[Dict]:
         """依 id 取使用者（給 Flask-Login 用）"""
-        session = self.Session()
-        try:
+        with self._session() as session:
             u = session.query(User).filter(User.id == user_id).first()
             if not u:
                 return None
             return {"id": u.id, "username": u.username}
-        finally:
-            session.close()
 
     # === 分類 ===
+    def _invalidate_category_cache(self, user_id: int):
+        with self._cat_cache_lock:
+            self._cat_cache.pop(user_id, None)
+
+    @_retry_on_disconnect
     def get_categories(self, user_id: int, category_type: Optional[str] = None) -> List[tuple]:
-        session = self.Session()
-        try:
-            query = session.query(Category).filter(Category.user_id == user_id)
-            if category_type:
-                cat_type = CategoryType.income if category_type == 'income' else CategoryType.expense
-                query = query.filter(Category.type == cat_type)
-            categories = query.order_by(Category.type, Category.name).all()
-            return [(cat.id, cat.name, cat.type.value) for cat in categories]
-        except Exception as e:
-            print(f"❌ 取得分類失敗: {e}")
-            return []
-        finally:
-            session.close()
+        with self._cat_cache_lock:
+            cached = self._cat_cache.get(user_id)
+            categories = cached[0] if cached and time.monotonic() - cached[1] < self._cat_cache_ttl else None
+
+        if categories is None:
+            try:
+                with self._session() as session:
+                    rows = session.execute(_CATEGORIES_STMT, {"user_id": user_id})
+                    categories = [(row.id, row.name, row.type.value) for row in rows]
+                with self._cat_cache_lock:
+                    self._cat_cache[user_id] = (categories, time.monotonic())
+            except OperationalError:
+                raise  # 交給 _retry_on_disconnect 換連線重試
+            except Exception as e:
+                print(f"❌ 取得分類失敗: {e}")
+                return []
+
+        if category_type:
+            return [cat for cat in categories if cat[2] == category_type]
+        return categories
+
+    def get_category_map(self, user_id: int) -> Dict[int, Tuple[str, str]]:
+        """id -> (name, type) 對照表；走 get_categories 的同一份 TTL 快取，
+        呼叫端解析分類名稱時不必 JOIN、也（通常）不必查 DB"""
+        return {cat_id: (name, type_value)
+                for cat_id, name, type_value in self.get_categories(user_id)}
 
     def add_category(self, user_id: int, name: str, category_type: str) -> bool:
         if category_type not in ['income', 'expense']:
             print("❌ 分類類型無效，必須是 'income' 或 'expense'。")
             return False
-        session = self.Session()
         try:
-            cat_type = CategoryType.income if category_type == 'income' else CategoryType.expense
-            category = Category(user_id=user_id, name=name, type=cat_type)
-            session.add(category)
-            session.commit()
-            return True
+            with self._session() as session:
+                cat_type = CategoryType.income if category_type == 'income' else CategoryType.expense
+                # 撞到 uq_user_category 時視為已存在（no-op），單一往返、不走例外回滾
+                stmt = mysql_insert(Category).values(user_id=user_id, name=name, type=cat_type)
+                stmt = stmt.on_duplicate_key_update(id=Category.id)
+                session.execute(stmt)
+                session.commit()
+                self._invalidate_category_cache(user_id)
+                return True
         except Exception as e:
             print(f"❌ 新增分類失敗: {e}")
-            session.rollback()
             return False
-        finally:
-            session.close()
 
     def delete_category(self, user_id: int, category_id: int) -> bool:
-        session = self.Session()
         try:
-            category = (
-                session.query(Category)
-                .filter(Category.id == category_id, Category.user_id == user_id)
-                .first()
-            )
-            if category:
-                session.delete(category)
+            with self._session() as session:
+                # 單發 DELETE：不先 SELECT、不建 ORM 物件；
+                # 底下交易的 category_id 由 DB 的 ON DELETE SET NULL 處理
+                deleted = (
+                    session.query(Category)
+                    .filter(Category.id == category_id, Category.user_id == user_id)
+                    .delete(synchronize_session=False)
+                )
                 session.commit()
-                return True
-            return False
+                if deleted:
+                    self._invalidate_category_cache(user_id)
+                return deleted == 1
         except Exception as e:
             print(f"❌ 刪除分類失敗: {e}")
-            session.rollback()
             return False
-        finally:
-            session.close()
 
     # === 交易 ===
     def add_transaction(
         self, user_id: int, amount: float, category_id: Optional[int],
         description: str = "", date: Optional[str] = None
     ) -> bool:
+        # fromisoformat 是 C 實作，比 strptime 快一個數量級
         if date is None:
-            date_obj = datetime.now().date()
+            date_obj = date_cls.today()
         else:
-            date_obj = datetime.strptime(date, "%Y-%m-%d").date()
-        session = self.Session()
+            date_obj = date_cls.fromisoformat(date)
         try:
-            # 確認分類屬於該用戶
-            category = None
-            if category_id:
-                category = (
-                    session.query(Category)
-                    .filter(Category.id == category_id, Category.user_id == user_id)
-                    .first()
+            with self._session() as session:
+                # 確認分類屬於該用戶（只撈 type 這一欄，順便拿到快照值）
+                cat_type = None
+                if category_id:
+                    cat_type = (
+                        session.query(Category.type)
+                        .filter(Category.id == category_id, Category.user_id == user_id)
+                        .limit(1)
+                        .scalar()
+                    )
+                    if cat_type is None:
+                        print("❌ 分類不屬於該用戶或不存在")
+                        return False
+
+                transaction = Transaction(
+                    user_id=user_id,
+                    amount=amount,
+                    category_id=category_id if cat_type else None,
+                    category_type=cat_type,
+                    description=description,
+                    date=date_obj,
                 )
-                if not category:
-                    print("❌ 分類不屬於該用戶或不存在")
-                    return False
-
-            transaction = Transaction(
-                user_id=user_id,
-                amount=amount,
-                category_id=category_id if category else None,
-                description=description,
-                date=date_obj,
-            )
-            session.add(transaction)
-            session.commit()
-            return True
+                session.add(transaction)
+                self._apply_balance_delta(session, user_id, date_obj, cat_type, amount)
+                session.commit()
+                return True
         except Exception as e:
             print(f"❌ 新增交易失敗: {e}")
-            session.rollback()
             return False
-        finally:
-            session.close()
 
+    def add_transactions_bulk(self, user_id: int, rows: List[Dict]) -> bool:
+        """批次新增交易（CSV 匯入等）：一個交易、一次多列 INSERT
+
+        rows 每筆為 {"amount": float, "category_id": Optional[int],
+                     "description": str, "date": "YYYY-MM-DD" 或 None}
+        """
+        try:
+            with self._session() as session:
+                # 一次查詢驗證所有 category_id 屬於該用戶，順便取得 type 快照
+                cat_ids = {r.get("category_id") for r in rows if r.get("category_id")}
+                cat_types: Dict[int, CategoryType] = {}
+                if cat_ids:
+                    cat_types = dict(
+                        session.query(Category.id, Category.type)
+                        .filter(Category.user_id == user_id, Category.id.in_(cat_ids))
+                        .all()
+                    )
+                    missing = cat_ids - set(cat_types)
+                    if missing:
+                        print(f"❌ 分類不屬於該用戶或不存在: {sorted(missing)}")
+                        return False
+
+                values = []
+                deltas: Dict[Tuple[str, CategoryType], float] = {}
+                for row in rows:
+                    date_str = row.get("date")
+                    date_obj = date_cls.fromisoformat(date_str) if date_str else date_cls.today()
+                    category_id = row.get("category_id") or None
+                    cat_type = cat_types.get(category_id)
+                    values.append({
+                        "user_id": user_id,
+                        "amount": row["amount"],
+                        "category_id": category_id,
+                        "category_type": cat_type,
+                        "description": row.get("description", ""),
+                        "date": date_obj,
+                    })
+                    if cat_type:
+                        key = (date_obj.strftime("%Y-%m"), cat_type)
+                        deltas[key] = deltas.get(key, 0.0) + row["amount"]
+
+                if not values:
+                    return True
+                session.execute(Transaction.__table__.insert(), values)
+                for (month, cat_type), delta in deltas.items():
+                    self._upsert_balance_total(session, user_id, month, cat_type, delta)
+                session.commit()
+                return True
+        except Exception as e:
+            print(f"❌ 批次新增交易失敗: {e}")
+            return False
+
+    @_retry_on_disconnect
     def get_transactions(self, user_id: int, limit: int = 10) -> List[tuple]:
-        session = self.Session()
         try:
-            transactions = (
-                session.query(Transaction)
-                .filter(Transaction.user_id == user_id)
-                .join(Category, Transaction.category_id == Category.id, isouter=True)
-                .order_by(Transaction.date.desc(), Transaction.created_at.desc())
-                .limit(limit)
-                .all()
-            )
-            result = []
-            for trans in transactions:
-                category_name = trans.category.name if trans.category else "未分類"
-                category_type = trans.category.type.value if trans.category else "unknown"
-                result.append((
-                    trans.id,
-                    trans.amount,
-                    category_name,
-                    category_type,
-                    trans.description or "",
-                    trans.date
-                ))
-            return result
+            with self._session() as session:
+                # 只取需要的欄位（Core SELECT），跳過 ORM 物件建構與 identity map
+                return [
+                    _transaction_row_to_tuple(row)
+                    for row in session.execute(_TRANSACTIONS_STMT, {"user_id": user_id, "limit": limit})
+                ]
+        except OperationalError:
+            raise  # 交給 _retry_on_disconnect 換連線重試
         except Exception as e:
             print(f"❌ 取得交易記錄失敗: {e}")
             return []
-        finally:
-            session.close()
 
+    def _upsert_balance_total(self, session, user_id: int, month: str, cat_type, delta: float):
+        stmt = mysql_insert(BalanceAggregate).values(
+            user_id=user_id,
+            month=month,
+            type=cat_type,
+            total=delta,
+        )
+        stmt = stmt.on_duplicate_key_update(total=BalanceAggregate.total + delta)
+        session.execute(stmt)
+
+    def _apply_balance_delta(self, session, user_id: int, date_obj, cat_type, delta: float):
+        """把一筆交易的金額差值 upsert 進 balance_aggregates（未分類交易不計）"""
+        if cat_type is None or not delta:
+            return
+        self._upsert_balance_total(session, user_id, date_obj.strftime("%Y-%m"), cat_type, delta)
+
+    @_retry_on_disconnect
+    def get_transactions_after(self, user_id: int, last_date, last_created, last_id: int,
+                               limit: int = 10) -> List[tuple]:
+        """keyset 分頁：取 (last_date, last_created, last_id) 游標之後的下一頁，深頁也不掃 OFFSET"""
+        try:
+            with self._session() as session:
+                return [
+                    _transaction_row_to_tuple(row)
+                    for row in session.execute(_TRANSACTIONS_AFTER_STMT, {
+                        "user_id": user_id,
+                        "last_date": last_date,
+                        "last_created": last_created,
+                        "last_id": last_id,
+                        "limit": limit,
+                    })
+                ]
+        except OperationalError:
+            raise  # 交給 _retry_on_disconnect 換連線重試
+        except Exception as e:
+            print(f"❌ 取得交易記錄失敗: {e}")
+            return []
+
+    def rebuild_balance_aggregates(self, user_id: Optional[int] = None) -> bool:
+        """從 transactions 重建彙總表（一次性 backfill 或資料修復用）"""
+        try:
+            with self._session() as session:
+                # 順便回填舊資料缺少的 category_type 快照
+                backfill_q = session.query(Transaction).options(
+                    joinedload(Transaction.category)
+                ).filter(
+                    Transaction.category_type.is_(None),
+                    Transaction.category_id.isnot(None),
+                )
+                if user_id is not None:
+                    backfill_q = backfill_q.filter(Transaction.user_id == user_id)
+                for trans in backfill_q.all():
+                    trans.category_type = trans.category.type if trans.category else None
+
+                delete_q = session.query(BalanceAggregate)
+                # 與增量維護同一套語意：彙總 category_type 快照（分類被刪後
+                # category_id 會被 SET NULL，但快照與既有彙總保留），不 JOIN categories
+                source_q = (
+                    session.query(
+                        Transaction.user_id,
+                        func.date_format(Transaction.date, "%Y-%m"),
+                        Transaction.category_type,
+                        func.sum(Transaction.amount),
+                    )
+                    .filter(Transaction.category_type.isnot(None))
+                    .group_by(Transaction.user_id, func.date_format(Transaction.date, "%Y-%m"), Transaction.category_type)
+                )
+                if user_id is not None:
+                    delete_q = delete_q.filter(BalanceAggregate.user_id == user_id)
+                    source_q = source_q.filter(Transaction.user_id == user_id)
+                delete_q.delete(synchronize_session=False)
+                for uid, month, cat_type, total in source_q.all():
+                    session.add(BalanceAggregate(user_id=uid, month=month, type=cat_type, total=float(total)))
+                session.commit()
+                return True
+        except Exception as e:
+            print(f"❌ 重建彙總表失敗: {e}")
+            return False
+
+    @_retry_on_disconnect
     def get_balance(self, user_id: int) -> dict:
-        session = self.Session()
         try:
-            income_sum = (
-                session.query(func.sum(Transaction.amount))
-                .join(Category, Transaction.category_id == Category.id)
-                .filter(Transaction.user_id == user_id, Category.type == CategoryType.income)
-                .scalar() or 0.0
-            )
-            expense_sum = (
-                session.query(func.sum(Transaction.amount))
-                .join(Category, Transaction.category_id == Category.id)
-                .filter(Transaction.user_id == user_id, Category.type == CategoryType.expense)
-                .scalar() or 0.0
-            )
-            return {
-                'total_income': float(income_sum),
-                'total_expense': float(expense_sum),
-                'balance': float(income_sum - expense_sum)
-            }
+            with self._session() as session:
+                # 讀小張的彙總表即可，不用每次掃 transactions JOIN categories
+                rows = dict(session.execute(_BALANCE_STMT, {"user_id": user_id}).all())
+                income_sum = rows.get(CategoryType.income) or 0.0
+                expense_sum = rows.get(CategoryType.expense) or 0.0
+                return {
+                    'total_income': float(income_sum),
+                    'total_expense': float(expense_sum),
+                    'balance': float(income_sum - expense_sum)
+                }
+        except OperationalError:
+            raise  # 交給 _retry_on_disconnect 換連線重試
         except Exception as e:
             print(f"❌ 計算餘額失敗: {e}")
             return {'total_income': 0, 'total_expense': 0, 'balance': 0}
-        finally:
-            session.close()
+
+    @_retry_on_disconnect
+    def get_monthly_summary(self, user_id: int) -> List[tuple]:
+        """每月收支報表：直接讀 balance_aggregates，不論歷史多長都只掃小表"""
+        try:
+            with self._session() as session:
+                rows = (
+                    session.query(BalanceAggregate.month, BalanceAggregate.type, BalanceAggregate.total)
+                    .filter(BalanceAggregate.user_id == user_id)
+                    .order_by(BalanceAggregate.month.desc())
+                    .all()
+                )
+                summary: Dict[str, Dict[str, float]] = {}
+                for month, cat_type, total in rows:
+                    entry = summary.setdefault(month, {"income": 0.0, "expense": 0.0})
+                    entry[cat_type.value] = float(total)
+                return [
+                    (month, v["income"], v["expense"], v["income"] - v["expense"])
+                    for month, v in summary.items()
+                ]
+        except OperationalError:
+            raise  # 交給 _retry_on_disconnect 換連線重試
+        except Exception as e:
+            print(f"❌ 取得月報表失敗: {e}")
+            return []
 
     def delete_transaction(self, user_id: int, transaction_id: int) -> bool:
-        session = self.Session()
         try:
-            transaction = (
-                session.query(Transaction)
-                .filter(Transaction.id == transaction_id, Transaction.user_id == user_id)
-                .first()
-            )
-            if transaction:
-                session.delete(transaction)
+            with self._session() as session:
+                # 彙總表要先知道這筆的 (date, type, amount)，只撈這三欄
+                row = (
+                    session.query(Transaction.date, Transaction.category_type, Transaction.amount)
+                    .filter(Transaction.id == transaction_id, Transaction.user_id == user_id)
+                    .first()
+                )
+                if row is None:
+                    return False
+                self._apply_balance_delta(session, user_id, row.date, row.category_type, -row.amount)
+                deleted = (
+                    session.query(Transaction)
+                    .filter(Transaction.id == transaction_id, Transaction.user_id == user_id)
+                    .delete(synchronize_session=False)
+                )
                 session.commit()
-                return True
-            return False
+                return deleted == 1
         except Exception as e:
             print(f"❌ 刪除失敗: {e}")
-            session.rollback()
-            return False
-        finally:
-            session.close()
\ No newline at end of file
+            return False
\ No newline at end of file